@@ -4,26 +4,97 @@ import os
 from sklearn.metrics.pairwise import cosine_similarity
 from utils import divide_into_three, get_categories
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.json as pa_json
+except ImportError:  # pyarrow is optional, pandas parsers are used without it
+    pa = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, NumPy fallbacks are used without it
+    njit = None
+    prange = range
+
+_CATEGORIES = tuple(get_categories())
+_PERSONAS = ("low", "mid", "high")
+_INTERACTION_COLUMNS = ["user_id", "book_id", "is_read", "rating", "is_reviewed"]
+
 
 def load_data(
     file_path: str, 
-    head: int | None = 500
+    head: int | None = 500,
+    columns: list[str] | None = None
 ) -> pd.DataFrame:
     """
-    Loads data from CSV and JSON files
+    Loads data from CSV and JSON files. Full files are parsed with pyarrow when available
     
     Args:
         file_path: file path 
         head: number of rows to load
+        columns: columns to load, all if None
     """
 
     file_extension = file_path.split(".")[-1]
+    use_pyarrow = pa is not None and head is None  # pyarrow readers don't support nrows
     if file_extension == "csv":
-        df = pd.read_csv(file_path, nrows=head)
+        df = pd.read_csv(file_path, nrows=head, usecols=columns, engine="pyarrow" if use_pyarrow else None)
     elif file_extension == "json":
-        df = pd.read_json(file_path, lines=True, orient='records', nrows=head)
+        if use_pyarrow:
+            table = pa_json.read_json(file_path)
+            if columns:
+                table = table.select(columns)
+            df = table.to_pandas()
+            # Structs get every key seen in the file, drop the missing ones to match pandas dicts
+            for field in table.schema:
+                if pa.types.is_struct(field.type):
+                    df[field.name] = df[field.name].map(
+                        lambda d: {k: v for k, v in d.items() if v is not None} if d else {}
+                    )
+        else:
+            df = pd.read_json(file_path, lines=True, orient='records', nrows=head)
+            if columns:
+                df = df[columns]
     return df
 
+def load_interactions(
+    file_path: str,
+    books: pd.Series,
+    head: int | None = None
+) -> pd.DataFrame:
+    """
+    Loads interactions from CSV keeping only rows of the given books. With pyarrow the
+    file is streamed in blocks and filtered before conversion to pandas
+
+    Args:
+        file_path: file path
+        books: book IDs to keep
+        head: number of rows to read from file
+    """
+
+    if pa is None:
+        df = load_data(file_path, head, _INTERACTION_COLUMNS)
+        return df[df["book_id"].isin(books)]
+
+    value_set = pa.array(books.to_numpy())
+    reader = pa_csv.open_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(block_size=64 << 20),
+        convert_options=pa_csv.ConvertOptions(include_columns=_INTERACTION_COLUMNS)
+    )
+    batches = []
+    rows_read = 0
+    for batch in reader:
+        if head is not None and rows_read + batch.num_rows > head:
+            batch = batch.slice(0, head - rows_read)
+        rows_read += batch.num_rows
+        batches.append(batch.filter(pc.is_in(batch.column("book_id"), value_set=value_set)))
+        if head is not None and rows_read >= head:
+            break
+    return pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+
 def get_model_df(
     load_users: int | None = None, 
     n_users: int = 100, 
@@ -63,8 +134,7 @@ def get_model_df(
     
     # Load all users data
     
-    df_users_raw = load_data(f"{file_path}/goodreads_interactions.csv", load_users)
-    df_users_with_books = df_users_raw[df_users_raw["book_id"].isin(books)]
+    df_users_with_books = load_interactions(f"{file_path}/goodreads_interactions.csv", books, load_users)
     df_users_filtered = process_df_users_raw(
         df=df_users_with_books, n_users=n_users, seed=seed, thresholds=thresholds, ignorant_proportion=ignorant_proportion
     )
@@ -83,13 +153,13 @@ def get_model_df(
     
     # Get categories into columns
     
-    df_items_filtered.loc[:, "genres"] = df_items_filtered["genres"].apply(reformat_dict)
-    df_items_filtered_normalized = pd.json_normalize(df_items_filtered["genres"])
-    df_items_result = pd.concat([df_items_filtered.reset_index(drop=True), df_items_filtered_normalized.reset_index(drop=True)], axis=1)
+    df_items_result = df_items_filtered.set_index("book_id")
+    df_items_filtered_normalized = reformat_genres(df_items_result["genres"])
+    df_items_result = pd.concat([df_items_result, df_items_filtered_normalized], axis=1)
     
     # Combine dfs and return
     
-    df_combined = pd.merge(df_users_filtered, df_items_result, how="inner", on="book_id")
+    df_combined = df_users_filtered.join(df_items_result, on="book_id", how="inner", validate="m:1").reset_index(drop=True)
     print(f"    - Model dataframe ready. Interactions: {len(df_combined)}")
     return df_combined.drop("genres", axis=1)
 
@@ -100,46 +170,44 @@ def process_df_users_raw(
     thresholds: tuple[int, int, int],
     ignorant_proportion: float
 ) -> pd.DataFrame:
+    # Downcast ids to shrink hashing for groupby and isin
+    df = df.assign(
+        user_id=pd.to_numeric(df["user_id"], downcast="unsigned"),
+        book_id=pd.to_numeric(df["book_id"], downcast="unsigned")
+    )
+
     # Filter to read-only entries
     read_only_df = df[df["is_read"] == 1]
 
     # Count books per user and filter users with up to top threshold books
-    tmp_df = read_only_df.groupby("user_id")["book_id"].count().reset_index().rename(columns={"book_id": "book_count"})
-    user_ids = tmp_df[tmp_df["book_count"] <= thresholds[2]]["user_id"].tolist()
-    filtered_df = df[df["user_id"].isin(user_ids)]
-    filtered_df = filtered_df.merge(tmp_df, on="user_id", how="left")
+    book_count = read_only_df.groupby("user_id")["book_id"].size()
+    user_ids = book_count.index[book_count <= thresholds[2]]
+    filtered_df = df[df["user_id"].isin(user_ids)].copy()
+    filtered_df["book_count"] = filtered_df["user_id"].map(book_count)
 
     # Divide users into three groups
     divisions = divide_into_three(n_users)
 
-    # Sample from each user group
-    low_df_user_ids = filtered_df[filtered_df["book_count"] <= thresholds[0]]
-    low_user_ids = low_df_user_ids["user_id"].drop_duplicates().sample(n=divisions[0], random_state=seed)
-    mid_df_user_ids = filtered_df[(filtered_df["book_count"] <= thresholds[1]) & (filtered_df["book_count"] > thresholds[0])]
-    mid_user_ids = mid_df_user_ids["user_id"].drop_duplicates().sample(n=divisions[1], random_state=seed)
-    high_df_user_ids = filtered_df[filtered_df["book_count"] > thresholds[1]]
-    high_user_ids = high_df_user_ids["user_id"].drop_duplicates().sample(n=divisions[2], random_state=seed)
-
-    # Concatenate samples into one DataFrame
-    low_df = filtered_df[filtered_df["user_id"].isin(low_user_ids)]
-    low_df["persona"] = "low"
-    mid_df = filtered_df[filtered_df["user_id"].isin(mid_user_ids)]
-    mid_df["persona"] = "mid"
-    high_df = filtered_df[filtered_df["user_id"].isin(high_user_ids)]
-    high_df["persona"] = "high"
-
-    # Add ignorance
-    if ignorant_proportion == 1.0:
-        for sub_df in [low_df, mid_df, high_df]:
-            sub_df['ignorant'] = True
-    elif ignorant_proportion > 0:
-        for sub_df in [low_df, mid_df, high_df]:
-            sub_df['ignorant'] = get_naiveness(sub_df, ignorant_proportion, seed)
-    else:
-        for sub_df in [low_df, mid_df, high_df]:
-            sub_df["ignorant"] = False
-
-    return pd.concat([low_df, mid_df, high_df])
+    # Bucket users by book count and sample from each group
+    user_book_count = book_count[book_count <= thresholds[2]]
+    bucket = pd.cut(
+        user_book_count, bins=[-np.inf, thresholds[0], thresholds[1], np.inf], labels=list(_PERSONAS)
+    )
+    sampled_personas = pd.concat([
+        bucket[bucket == persona].sample(n=divisions[i], random_state=seed)
+        for i, persona in enumerate(_PERSONAS)
+    ])
+    filtered_df = filtered_df[filtered_df["user_id"].isin(sampled_personas.index)]
+    filtered_df = filtered_df.assign(persona=filtered_df["user_id"].map(sampled_personas).astype(str))
+
+    # Add ignorance to a proportion of users of each persona
+    ignorant_users = []
+    if ignorant_proportion > 0:
+        for persona in _PERSONAS:
+            persona_users = sampled_personas.index[sampled_personas == persona].to_series()
+            shuffled_users = persona_users.sample(frac=1, random_state=seed)
+            ignorant_users.extend(shuffled_users.iloc[:round(len(shuffled_users) * ignorant_proportion)])
+    return filtered_df.assign(ignorant=filtered_df["user_id"].isin(ignorant_users))
 
 def get_naiveness(df: pd.DataFrame, ignorant_proportion: float, seed: int | None) -> pd.Series:
     """
@@ -165,21 +233,22 @@ def get_naiveness(df: pd.DataFrame, ignorant_proportion: float, seed: int | None
     else:
         return df.index.map(naiveness_map)
 
-def reformat_dict(d: dict) -> dict:
+def reformat_genres(genres: pd.Series) -> pd.DataFrame:
     """
-    Reformats dict from JSON as columns for df
+    Reformats genre dicts from JSON as category columns for df
 
-    Args: 
-        d: dictionary containing categories and their count
+    Args:
+        genres: series of dictionaries containing categories and their count
     """
-    
-    genres = {}
-    for genre, value in d.items():
+
+    normalized = pd.json_normalize(genres.tolist()).set_axis(genres.index).fillna(0)
+    normalized = normalized.clip(lower=0)  # Some genres had a -1, so they were removed
+    result = pd.DataFrame(0, index=normalized.index, columns=list(_CATEGORIES))
+    for genre in normalized.columns:
         for g in genre.split(","):
             g = g.strip().replace(" ", "_").replace("-", "_")
-            genres[g] = genres.get(g, 0) + value if value > 0 else 0  # Some genres had a -1, so they were removed
-    genres.update({k: 0 for k in get_categories() if k not in genres})
-    return genres
+            result[g] = result.get(g, 0) + normalized[genre]
+    return result.astype(int)
 
 def get_items_df(df: pd.DataFrame, priority: str | None = None, verbose: bool = False) -> pd.DataFrame:
     """
@@ -192,16 +261,15 @@ def get_items_df(df: pd.DataFrame, priority: str | None = None, verbose: bool =
     
     if verbose:
         print("Getting items dataframe...")
-    cat_cols = get_categories()
+    cat_cols = list(_CATEGORIES)
     aggregations = {
         "is_read": "sum",
         "rating": "mean",
         "is_reviewed": "sum"
     }
     aggregations.update({k: "mean" for k in cat_cols})
-    tmp_df = df.copy().drop("user_id", axis=1)
-    items_df = tmp_df.groupby(by=["book_id"]).agg(aggregations)
-    items_df["vector"] = items_df.apply(lambda row: np.array(row[cat_cols]).reshape(1, -1), axis=1)
+    items_df = df.groupby(by=["book_id"]).agg(aggregations)
+    items_df["vector"] = list(items_df[cat_cols].to_numpy(dtype=np.float32).reshape(-1, 1, len(cat_cols)))
     items_df = items_df.drop(cat_cols, axis=1)
     items_df["priority"] = items_df.apply(calculate_priority, args=(priority,), axis=1)
     
@@ -218,7 +286,7 @@ def calculate_priority(row: pd.Series, priority: str | float | None = None) -> f
         priority: priority strategy
     """
 
-    categories = get_categories()
+    categories = _CATEGORIES
     if not priority:
         return 0
     elif isinstance(priority, float):
@@ -253,10 +321,7 @@ def get_users_df(
     """
     if verbose:
         print("Getting users dataframe...")
-    tmp_df = df.copy()
-    cat_cols = get_categories()
-    for col in cat_cols:
-        tmp_df[col] = tmp_df[col].apply(lambda x: 1 if x > 0 else 0)
+    cat_cols = list(_CATEGORIES)
     aggregations = {
         "is_reviewed": "sum",
         "is_read": "sum",
@@ -265,6 +330,10 @@ def get_users_df(
         "ignorant": "first",
         "persona": "first"
     }
+    cat_block = (df[cat_cols].to_numpy() > 0).astype(np.int8)
+    tmp_df = pd.concat(
+        [df[["user_id", *aggregations]], pd.DataFrame(cat_block, columns=cat_cols, index=df.index)], axis=1
+    )
     aggregations.update({k: "sum" for k in cat_cols})
     
     # Calculate probabilities of reading for each user
@@ -277,18 +346,16 @@ def get_users_df(
     high_readers_proba = round(high_readers_average / 360, 4)
 
     users_df = tmp_df.groupby(by=["user_id"]).agg(aggregations)
-    users_df["vector"] = users_df.apply(lambda row: np.array(row[cat_cols]).reshape(1, -1), axis=1)
+    users_df["vector"] = list(users_df[cat_cols].to_numpy(dtype=np.float32).reshape(-1, 1, len(cat_cols)))
     users_df = users_df.drop(cat_cols, axis=1)
-    users_df["book_id"] = users_df.apply(calculate_book_score, args=(df_items,), axis=1)
-    users_df["read_proba"] = np.where(
-        users_df["is_read"] <= thresholds[0], 
-        low_readers_proba, 
-        np.where(
-            users_df["is_read"] <= thresholds[1], 
-            mid_readers_proba, 
-            high_readers_proba
-        )
-    )
+    item_arrays = get_item_arrays(df_items)
+    users_df["book_id"] = [
+        calculate_book_score(user_vector, book_ids, *item_arrays)
+        for user_vector, book_ids in zip(users_df["vector"], users_df["book_id"])
+    ]
+    read_probas = np.array([low_readers_proba, mid_readers_proba, high_readers_proba])
+    read_buckets = np.searchsorted(np.array(thresholds[:2]), users_df["is_read"].to_numpy(), side="left")
+    users_df["read_proba"] = read_probas[read_buckets]
 
     if social_influence:
         users_df = get_social_influences(users_df)
@@ -326,34 +393,91 @@ def matrix_cosine_similarity(df_reference: pd.DataFrame, df_compare: pd.DataFram
     """
     # Calculate matrixes and similarites
 
-    tmp_reference = df_reference["vector"].apply(lambda x: x.reshape(16).astype(float))
-    tmp_compare = df_compare["vector"].apply(lambda x: x.reshape(16).astype(float))
-    matrix_reference = np.stack(tmp_reference.values)
-    matrix_compare = np.stack(tmp_compare.values)
-    norms_reference = np.linalg.norm(matrix_reference, axis=1)
-    norms_compare = np.linalg.norm(matrix_compare, axis=1)
-    matrix_reference_normalized = matrix_reference / norms_reference[:, np.newaxis]
-    matrix_compare_normalized = matrix_compare / norms_compare[:, np.newaxis]
-    similarities = np.dot(matrix_reference_normalized, matrix_compare_normalized.T)
-
-    # Override with priority
-
-    priority_indices = np.where(df_compare["priority"] == 1)[0]
-    for idx in priority_indices:
-        ref_indices = np.where(df_reference['ignorant'] == False)[0]
-        non_ignorant_indices = set(range(len(df_reference))) - set(ref_indices)
-        similarities[list(non_ignorant_indices), idx] = 1.0
-
+    matrix_reference = np.ascontiguousarray(
+        np.stack(df_reference["vector"].values).reshape(len(df_reference), -1), dtype=np.float32
+    )
+    matrix_compare = np.ascontiguousarray(
+        np.stack(df_compare["vector"].values).reshape(len(df_compare), -1), dtype=np.float32
+    )
+    norms_reference = np.sqrt(np.einsum("ij,ij->i", matrix_reference, matrix_reference))
+    norms_compare = np.sqrt(np.einsum("ij,ij->i", matrix_compare, matrix_compare))
+    matrix_reference /= norms_reference[:, np.newaxis] + 1e-12
+    matrix_compare /= norms_compare[:, np.newaxis] + 1e-12
+
+    # Calculate top n similarities, overriding priority items for ignorant users
+
+    k = min(n, len(df_compare))
+    priority_items = (df_compare["priority"] == 1).to_numpy()
+    override_rows = (df_reference["ignorant"] != False).to_numpy()
+    similarities = matrix_reference @ matrix_compare.T
+    similarities[np.ix_(override_rows, priority_items)] = 1.0
+    similarities = np.round(similarities, 4)
+    if njit is not None:
+        top_indices, top_values = _top_k_columns_kernel(similarities, k)
+    else:
+        top_indices, top_values = top_k_columns(similarities, k)
     
     # Add similarities as column to reference df
     
+    compare_ids = df_compare.index.values
     df_reference["similarities"] = [
-        dict(sorted({df_compare.index[j]: round(similarities[i, j], 4) for j in range(len(df_compare))}.items(),
-            key=lambda item: item[1], reverse=True)[:n])
+        dict(zip(compare_ids[top_indices[i]].tolist(), np.round(top_values[i].astype(np.float64), 4).tolist()))
         for i in range(len(df_reference))
     ]
     return df_reference
 
+def top_k_columns(similarities: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Top k columns per row sorted by value, ties broken by lowest column index
+
+    Args:
+        similarities: similarity matrix
+        k: number of columns to return per row
+    """
+    # k-th largest value per row is the cutoff, tied columns at the cutoff are taken lowest index first
+    cutoff = -np.partition(-similarities, k - 1, axis=1)[:, k - 1:k]
+    above = similarities > cutoff
+    at_cutoff = similarities == cutoff
+    missing = k - above.sum(axis=1, keepdims=True)
+    selected = above | (at_cutoff & (np.cumsum(at_cutoff, axis=1) <= missing))
+    top_indices = np.nonzero(selected)[1].reshape(-1, k)
+    top_values = np.take_along_axis(similarities, top_indices, axis=1)
+    order = np.argsort(-top_values, axis=1, kind="stable")
+    return np.take_along_axis(top_indices, order, axis=1), np.take_along_axis(top_values, order, axis=1)
+
+def _top_k_columns_kernel(similarities: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Same selection as top_k_columns with a bounded top k per row, parallel over rows with numba
+    """
+    n_reference, n_compare = similarities.shape
+    top_indices = np.empty((n_reference, k), dtype=np.int64)
+    top_values = np.empty((n_reference, k), dtype=similarities.dtype)
+    for u in prange(n_reference):
+        row = similarities[u]
+        cutoff = -np.partition(-row, k - 1)[k - 1]
+        missing = k
+        for i in range(n_compare):
+            if row[i] > cutoff:
+                missing -= 1
+        candidates = np.empty(k, dtype=np.int64)
+        m = 0
+        for i in range(n_compare):
+            if row[i] > cutoff:
+                candidates[m] = i
+                m += 1
+            elif row[i] == cutoff and missing > 0:
+                missing -= 1
+                candidates[m] = i
+                m += 1
+        order = np.argsort(-row[candidates], kind="mergesort")
+        for m in range(k):
+            top_indices[u, m] = candidates[order[m]]
+            top_values[u, m] = row[candidates[order[m]]]
+    return top_indices, top_values
+
+if njit is not None:
+    _top_k_columns_kernel = njit(parallel=True, cache=True)(_top_k_columns_kernel)
+
 def get_social_influences(df: pd.DataFrame, top_k: int = 5) -> pd.DataFrame:
     """Get users to follow based on cosine similarity between them
     
@@ -372,23 +496,71 @@ def get_social_influences(df: pd.DataFrame, top_k: int = 5) -> pd.DataFrame:
     df["following"] = df.index.map(find_top_5_similar)
     return df
 
-def calculate_book_score(row: pd.Series, df_items: pd.DataFrame) -> dict:
+def get_item_arrays(df_items: pd.DataFrame) -> tuple[pd.Index, np.ndarray, np.ndarray, np.ndarray]:
     """
-    Calculate item scores based on cosine similarity with users
-    
+    Stack items data into arrays for vectorized lookups
+
     Args:
-        row: users dataframe row
         df_items: items dataframe
     """
+    item_index = df_items.index
+    item_matrix = np.stack(df_items["vector"].values).reshape(len(df_items), -1).astype(np.float32, copy=False)
+    item_norms = np.linalg.norm(item_matrix, axis=1)
+    item_priority = df_items["priority"].to_numpy(dtype=float)
+    return item_index, item_matrix, item_norms, item_priority
+
+def calculate_book_score(
+    user_vector: np.ndarray,
+    book_ids: list[int],
+    item_index: pd.Index,
+    item_matrix: np.ndarray,
+    item_norms: np.ndarray,
+    item_priority: np.ndarray
+) -> dict:
+    """
+    Calculate item scores based on cosine similarity with users
+
+    Args:
+        user_vector: user category vector
+        book_ids: list of book IDs interacted by user
+        item_index, item_matrix, item_norms, item_priority: items arrays from get_item_arrays
+    """
 
-    books = {}
-    user_vector = row["vector"]
-    for book_id in row["book_id"]:
-        item = df_items[df_items.index == book_id]
-        if item["priority"].item() > 0:
-            books.update({book_id: item["priority"].item()})
+    user_vector = np.asarray(user_vector, dtype=np.float32).reshape(-1)
+    idx = item_index.get_indexer(book_ids)
+    if (idx < 0).any():
+        missing = [book_id for book_id, i in zip(book_ids, idx) if i < 0]
+        raise KeyError(f"Book IDs not found in items dataframe: {missing}")
+    if njit is not None:
+        scores = _book_score_kernel(user_vector, item_matrix, item_norms, item_priority, idx)
+    else:
+        similarities = (item_matrix[idx] @ user_vector) / (item_norms[idx] * np.linalg.norm(user_vector) + 1e-12)
+        priorities = item_priority[idx]
+        scores = np.where(priorities > 0, priorities, similarities)
+    return dict(zip(book_ids, np.round(scores, 4).tolist()))
+
+def _book_score_kernel(
+    user_vector: np.ndarray,
+    item_matrix: np.ndarray,
+    item_norms: np.ndarray,
+    item_priority: np.ndarray,
+    idx: np.ndarray
+) -> np.ndarray:
+    """
+    Score loop over a user's books, compiled with numba when available
+    """
+    user_norm = np.sqrt(np.sum(user_vector * user_vector))
+    scores = np.empty(idx.size, dtype=np.float64)
+    for k in range(idx.size):
+        i = idx[k]
+        if item_priority[i] > 0:
+            scores[k] = item_priority[i]
         else:
-            item_vector = item["vector"].item()
-            similarity = cosine_similarity(user_vector, item_vector)
-            books.update({book_id: round(similarity[0][0], 4)})
-    return books
+            s = 0.0
+            for j in range(item_matrix.shape[1]):
+                s += user_vector[j] * item_matrix[i, j]
+            scores[k] = s / (item_norms[i] * user_norm + 1e-12)
+    return scores
+
+if njit is not None:
+    _book_score_kernel = njit(fastmath=True, cache=True)(_book_score_kernel)
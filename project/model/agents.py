@@ -146,8 +146,8 @@ class UserAgent(mesa.Agent):
             return []
         rec_list = []
         for user_id in self.following:
-            agent = [agent for agent in self.model.get_agents_of_type(UserAgent) if agent.user_id == user_id]
-            rec_list.extend(book for book in agent[0].books_consumed if book not in rec_list)
+            agent = self.model.users_by_user_id[user_id]
+            rec_list.extend(book for book in agent.books_consumed if book not in rec_list)
         return rec_list
 
     def pick_choice(self, recs: dict) -> ItemAgent | None:
@@ -163,8 +163,7 @@ class UserAgent(mesa.Agent):
         books = list(recs.keys())
         probabilities = list(recs.values())
         choice = random.choices(books, weights=probabilities, k=1)[0]
-        item = [i for i in self.model.get_agents_of_type(ItemAgent) if i.book_id == choice]
-        return item[0]
+        return self.model.items_by_book_id[choice]
 
     def get_top_books(self, n_books) -> list[int]:
         """
@@ -156,6 +156,7 @@ class RecommenderSystemModel(mesa.Model):
         user_agents = df_users.apply(self.create_user, axis=1)
         for a in user_agents:
             self.schedule.add(a)
+        self.users_by_user_id = {a.user_id: a for a in user_agents}
         if self.verbose:
             print(f"    - Users added")
         
@@ -166,6 +167,7 @@ class RecommenderSystemModel(mesa.Model):
         item_agents = df_items.apply(self.create_item, axis=1)
         for i in item_agents:
             self.schedule.add(i)
+        self.items_by_book_id = {i.book_id: i for i in item_agents}
         if self.verbose:
             print(f"    - Items added")
             print("Finished model initialization!")
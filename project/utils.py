@@ -2,7 +2,7 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import os
-from typing import Any
+from typing import Any, Iterator
 import ast
 from sklearn.metrics.pairwise import cosine_similarity
 import seaborn as sns
@@ -99,15 +99,34 @@ def plot_vector_diffs_by_persona(df: pd.DataFrame, model: str) -> None:
     plt.xlim(0.5, 1)
     plt.show()
 
+def iter_file_paths(directory: str) -> Iterator[str]:
+    """
+    Lazily yield paths of all files under directory
+    """
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    yield entry.path
+
 def list_file_paths(directory: str) -> list:
-    file_paths = []
-    for root, _, files in os.walk(directory):
-        for filename in files:
-            filepath = os.path.join(root, filename)
-            file_paths.append(filepath)
-    return file_paths
+    return list(iter_file_paths(directory))
+
+def index_results(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Index results dataframe by sorted (AgentID, Step) for repeated get_value_from_results lookups
+    """
+    return df.set_index(["AgentID", "Step"]).sort_index()
 
 def get_value_from_results(df: pd.DataFrame, id: int, col_name: str, step: int | None = None) -> Any:
+    if list(df.index.names) == ["AgentID", "Step"]:
+        if step in (0, -1):
+            steps = df.loc[id].index
+            step = steps.min() if step == 0 else steps.max()
+        return df.at[(id, step), col_name]
     if "AgentID" not in df.columns:
         filtered_df = df[df["unique_id"] == id]
         return filtered_df[col_name].iloc[0]
@@ -141,42 +160,28 @@ def plot_book_distribution_by_genre(df: pd.DataFrame, stats: str = "max", filter
     """
     Distribution of books by genre with stacked bars for the top three genre positions per book.
     """
-    tmp_df = df.copy()
-    # Apply normalization
-    tmp_df["vector"] = tmp_df["vector"].apply(string_to_array)
-    tmp_df["normalized_vector"] = tmp_df["vector"].apply(lambda x: normalize_vector(x.flatten()))
-    tmp_df = tmp_df[tmp_df["normalized_vector"].apply(lambda x: isinstance(x, np.ndarray))]
+    # Stack vectors into a matrix and normalize, dropping empty vectors
+    matrix = np.stack([string_to_array(v).reshape(-1) for v in df["vector"].values]).astype(np.float32)
+    sums = matrix.sum(axis=1, keepdims=True)
+    matrix = matrix[sums[:, 0] > 0] / sums[sums[:, 0] > 0]
 
     if filtered:
         categories = get_filtered_categories()
-        tmp_df["normalized_vector"] = tmp_df["normalized_vector"].apply(lambda x: np.delete(x, [-1, 1]))
+        matrix = np.delete(matrix, [-1, 1], axis=1)
         title = "(without fiction and non_fiction)"
     else:
         categories = get_categories()
         title = ""
 
-    # Extract the top 3 indices for each vector
-    def top_indices(x):
-        unique_values = np.unique(x)[::-1]
-        top_indices = []
-        for value in unique_values[:3]: 
-            indices = np.where(x == value)
-            top_indices.append(list(indices[0]))
-
-        while len(top_indices) < 3:
-            top_indices.append(None)
-        
-        return top_indices
-
-    tmp_df["top_indices"] = tmp_df["normalized_vector"].apply(top_indices)
-    tmp_df["max_position"] = tmp_df["top_indices"].apply(lambda x: x[0])
-    tmp_df["second_max_position"] = tmp_df["top_indices"].apply(lambda x: x[1])
-    tmp_df["third_max_position"] = tmp_df["top_indices"].apply(lambda x: x[2])
+    # Get the top 3 distinct values for each vector (ties count for every tied genre)
+    first = matrix.max(axis=1, keepdims=True)
+    second = np.where(matrix < first, matrix, -np.inf).max(axis=1, keepdims=True)
+    third = np.where(matrix < second, matrix, -np.inf).max(axis=1, keepdims=True)
 
-    # Calculate counts and reindex to include all categories
-    max_values = tmp_df.explode("max_position")["max_position"].value_counts().reindex(range(len(categories)), fill_value=0)
-    second_max_values = tmp_df.explode("second_max_position")["second_max_position"].value_counts().reindex(range(len(categories)), fill_value=0)
-    third_max_values = tmp_df.explode("third_max_position")["third_max_position"].value_counts().reindex(range(len(categories)), fill_value=0)
+    # Calculate counts for all categories
+    max_values = pd.Series((matrix == first).sum(axis=0))
+    second_max_values = pd.Series((matrix == second).sum(axis=0))
+    third_max_values = pd.Series((matrix == third).sum(axis=0))
 
     # Print stats
     total_counts = max_values + second_max_values + third_max_values